@@ -30,6 +30,36 @@ def order_points(pts):
     # bottom-right, and bottom-left order
     return np.array([tl, tr, br, bl], dtype = "float32")
 
+def order_points_batch(pts):
+    # apply order_points to a (K, 4, 2) batch of quadrilaterals
+    # at once, one step at a time along the second axis
+    pts = np.asarray(pts, dtype = "float32")
+    rows = np.arange(len(pts))[:, np.newaxis]
+
+    # sort the points based on their x-coordinates and split
+    # them into the left-most and right-most pairs
+    xSorted = pts[rows, np.argsort(pts[..., 0], axis = 1)]
+    leftMost = xSorted[:, :2]
+    rightMost = xSorted[:, 2:]
+
+    # sort the left-most pairs by their y-coordinates to grab
+    # the top-left and bottom-left points
+    leftMost = leftMost[rows, np.argsort(leftMost[..., 1], axis = 1)]
+    tl = leftMost[:, 0]
+    bl = leftMost[:, 1]
+
+    # the right-most point furthest from the top-left point is
+    # the bottom-right one
+    diff = rightMost.astype("float64") - tl[:, np.newaxis]
+    D = np.sqrt((diff ** 2).sum(axis = 2))
+    rightMost = rightMost[rows, np.argsort(D, axis = 1)[:, ::-1]]
+    br = rightMost[:, 0]
+    tr = rightMost[:, 1]
+
+    # return the coordinates in top-left, top-right,
+    # bottom-right, and bottom-left order
+    return np.stack([tl, tr, br, bl], axis = 1)
+
 def four_point_transform(image, pts):
     # obtain a consistent order of the points and unpack them
     # individually
@@ -20,7 +20,6 @@ Scanned images will be output to directory named 'output'
 from docopt import docopt
 from pyimagesearch import transform
 from pyimagesearch import imutils
-from scipy.spatial import distance as dist
 from matplotlib.patches import Polygon
 import polygon_interacter as poly_i
 import numpy as np
@@ -29,12 +28,94 @@ import itertools
 import math
 import cv2
 from pylsd.lsd import lsd
+from numba import njit
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import os
 
 import segmentation
 
 
+@njit(cache=True)
+def _quad_angle_range(quad):
+    """
+    Returns the range between max and min interior angles (in degrees) of a (4, 2)
+    quadrilateral. Each angle at vertex j is taken between the segments to its
+    neighbours j - 1 and j + 1. Degenerate quadrilaterals get an infinite range.
+    """
+    min_angle = 180.0
+    max_angle = 0.0
+    for j in range(4):
+        i = (j + 3) % 4
+        k = (j + 1) % 4
+        ax = quad[i, 0] - quad[j, 0]
+        ay = quad[i, 1] - quad[j, 1]
+        bx = quad[k, 0] - quad[j, 0]
+        by = quad[k, 1] - quad[j, 1]
+        norm = math.sqrt(ax * ax + ay * ay) * math.sqrt(bx * bx + by * by)
+        if norm == 0.0:
+            return np.inf
+        cos = min(max((ax * bx + ay * by) / norm, -1.0), 1.0)
+        angle = math.degrees(math.acos(cos))
+        min_angle = min(min_angle, angle)
+        max_angle = max(max_angle, angle)
+    return max_angle - min_angle
+
+
+@njit(cache=True)
+def _all_quad_angle_ranges(quads):
+    """Returns the angle range of every quadrilateral in a (K, 4, 2) batch"""
+    ranges = np.empty(quads.shape[0])
+    for i in range(quads.shape[0]):
+        ranges[i] = _quad_angle_range(quads[i])
+    return ranges
+
+
+def _extend_segments(segments, axis, limit):
+    """
+    Orders the endpoints of (N, 4) line segments along the given axis (0 for x, 1 for y)
+    and extends both ends by 5 pixels, clipped to [0, limit - 1]. Returns an (N, 2, 1, 2)
+    array ready for cv2.polylines.
+    """
+    swap = segments[:, 2 + axis] < segments[:, axis]
+    segments = np.where(swap[:, None], segments[:, [2, 3, 0, 1]], segments)
+    segments[:, axis] = np.maximum(segments[:, axis] - 5, 0)
+    segments[:, 2 + axis] = np.minimum(segments[:, 2 + axis] + 5, limit - 1)
+    return segments.reshape(-1, 2, 1, 2)
+
+
+@njit(cache=True)
+def _line_end_coords(labels, k, lo, hi):
+    """
+    Returns the mean row of the pixels labelled k in columns lo and hi of labels, i.e. the
+    y coordinates at both ends of a horizontal line component. Pass labels.T for vertical lines.
+    """
+    lo_sum = lo_count = hi_sum = hi_count = 0
+    for row in range(labels.shape[0]):
+        if labels[row, lo] == k:
+            lo_sum += row
+            lo_count += 1
+        if labels[row, hi] == k:
+            hi_sum += row
+            hi_count += 1
+    return lo_sum // lo_count, hi_sum // hi_count
+
+
+@lru_cache(maxsize=32)
+def _comb_indices(n, k=4):
+    """Returns a read-only (C(n, k), k) array of every k-combination of range(n)"""
+    idx = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(n), k)), dtype=np.int64)
+    idx = idx.reshape(-1, k)
+    idx.flags.writeable = False
+    return idx
+
+
+def _largest_components(stats, n=2):
+    """Returns the labels of the n largest foreground components from connectedComponentsWithStats"""
+    return np.argsort(-stats[1:, cv2.CC_STAT_AREA], kind="stable")[:n] + 1
+
+
 class DocScanner(object):
     """An image scanner"""
 
@@ -57,37 +138,20 @@ class DocScanner(object):
         self.debug = debug
         self.write_contours = write_contours
 
-    def filter_corners(self, corners, min_dist=20):
-        """Filters corners that are within min_dist of others"""
-
-        def predicate(representatives, corner):
-            return all(dist.euclidean(representative, corner) >= min_dist
-                       for representative in representatives)
-
-        filtered_corners = []
-        for c in corners:
-            if predicate(filtered_corners, c):
-                filtered_corners.append(c)
-        return filtered_corners
-
-    def angle_between_vectors_degrees(self, u, v):
-        """Returns the angle between two vectors in degrees"""
-        return np.degrees(
-            math.acos(np.dot(u, v) / (np.linalg.norm(u) * np.linalg.norm(v))))
+        # closing kernel used by get_contour
+        self._morph_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
 
-    def get_angle(self, p1, p2, p3):
-        """
-        Returns the angle between the line segment from p2 to p1 
-        and the line segment from p2 to p3 in degrees
-        """
-        a = np.radians(np.array(p1))
-        b = np.radians(np.array(p2))
-        c = np.radians(np.array(p3))
-
-        avec = a - b
-        cvec = c - b
-
-        return self.angle_between_vectors_degrees(avec, cvec)
+    def filter_corners(self, corners, min_dist=20):
+        """Filters corners (an (N, 2) array) that are within min_dist of others"""
+        pts = np.asarray(corners).reshape(-1, 2)
+        reps = np.empty((len(pts), 2), dtype=np.float32)
+        keep = []
+        for i, p in enumerate(pts):
+            d = reps[:len(keep)] - p
+            if not keep or np.einsum('ij,ij->i', d, d).min() >= min_dist * min_dist:
+                reps[len(keep)] = p
+                keep.append(i)
+        return pts[keep]
 
     def angle_range(self, quad):
         """
@@ -95,18 +159,11 @@ class DocScanner(object):
         The input quadrilateral must be a numpy array with vertices ordered clockwise
         starting with the top left vertex.
         """
-        tl, tr, br, bl = quad
-        ura = self.get_angle(tl[0], tr[0], br[0])
-        ula = self.get_angle(bl[0], tl[0], tr[0])
-        lra = self.get_angle(tr[0], br[0], bl[0])
-        lla = self.get_angle(br[0], bl[0], tl[0])
-
-        angles = [ura, ula, lra, lla]
-        return np.ptp(angles)
+        return _quad_angle_range(np.asarray(quad).reshape(4, 2).astype(np.float64))
 
     def get_corners(self, img, log_img_dir, orig_img):
         """
-        Returns a list of corners ((x, y) tuples) found in the input image. With proper
+        Returns an (N, 2) array of corners (x, y) found in the input image. With proper
         pre-processing and filtering, it should output at most 10 potential corners.
         This is a utility function used by get_contours. The input image is expected 
         to be rescaled and Canny filtered prior to be passed in.
@@ -129,56 +186,47 @@ class DocScanner(object):
         # 6. Repeat for vertical lines
         # 7. Draw all the final lines onto another canvas. Where the lines overlap are also corners
 
-        corners = []
+        corners = np.empty((0, 2), dtype=np.int32)
         if lines is not None:
             # separate out the horizontal and vertical lines, and draw them back onto separate canvases
-            lines = lines.squeeze().astype(np.int32).tolist()
+            lines = lines.reshape(-1, 5)[:, :4].astype(np.int32)
+            horizontal = np.abs(lines[:, 2] - lines[:, 0]) > np.abs(lines[:, 3] - lines[:, 1])
             horizontal_lines_canvas = np.zeros(img.shape, dtype=np.uint8)
             vertical_lines_canvas = np.zeros(img.shape, dtype=np.uint8)
-            for line in lines:
-                x1, y1, x2, y2, _ = line
-                if abs(x2 - x1) > abs(y2 - y1):
-                    (x1, y1), (x2, y2) = sorted(((x1, y1), (x2, y2)), key=lambda pt: pt[0])
-                    cv2.line(horizontal_lines_canvas, (max(x1 - 5, 0), y1), (min(x2 + 5, img.shape[1] - 1), y2), 255, 2)
-                else:
-                    (x1, y1), (x2, y2) = sorted(((x1, y1), (x2, y2)), key=lambda pt: pt[1])
-                    cv2.line(vertical_lines_canvas, (x1, max(y1 - 5, 0)), (x2, min(y2 + 5, img.shape[0] - 1)), 255, 2)
+            for canvas, segments, axis in ((horizontal_lines_canvas, lines[horizontal], 0),
+                                           (vertical_lines_canvas, lines[~horizontal], 1)):
+                if len(segments):
+                    segments = _extend_segments(segments, axis, img.shape[1 - axis])
+                    cv2.polylines(canvas, list(segments), False, 255, 2)
 
             lines = []
 
             # find the horizontal lines (connected-components -> bounding boxes -> final lines)
-            (contours, hierarchy) = cv2.findContours(horizontal_lines_canvas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-            contours = sorted(contours, key=lambda c: cv2.arcLength(c, True), reverse=True)[:2]
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(horizontal_lines_canvas, connectivity=8,
+                                                                   ltype=cv2.CV_32S)
             horizontal_lines_canvas = np.zeros(img.shape, dtype=np.uint8)
-            for contour in contours:
-                contour = contour.reshape((contour.shape[0], contour.shape[2]))
-                min_x = np.amin(contour[:, 0], axis=0) + 2
-                max_x = np.amax(contour[:, 0], axis=0) - 2
-                left_y = int(np.average(contour[contour[:, 0] == min_x][:, 1]))
-                right_y = int(np.average(contour[contour[:, 0] == max_x][:, 1]))
+            for k in _largest_components(stats):
+                min_x = int(stats[k, cv2.CC_STAT_LEFT]) + 2
+                max_x = int(stats[k, cv2.CC_STAT_LEFT] + stats[k, cv2.CC_STAT_WIDTH]) - 1 - 2
+                left_y, right_y = _line_end_coords(labels, k, min_x, max_x)
                 lines.append((min_x, left_y, max_x, right_y))
                 cv2.line(horizontal_lines_canvas, (min_x, left_y), (max_x, right_y), 1, 1)
-                corners.append((min_x, left_y))
-                corners.append((max_x, right_y))
 
             # find the vertical lines (connected-components -> bounding boxes -> final lines)
-            (contours, hierarchy) = cv2.findContours(vertical_lines_canvas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-            contours = sorted(contours, key=lambda c: cv2.arcLength(c, True), reverse=True)[:2]
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(vertical_lines_canvas, connectivity=8,
+                                                                   ltype=cv2.CV_32S)
             vertical_lines_canvas = np.zeros(img.shape, dtype=np.uint8)
-            for contour in contours:
-                contour = contour.reshape((contour.shape[0], contour.shape[2]))
-                min_y = np.amin(contour[:, 1], axis=0) + 2
-                max_y = np.amax(contour[:, 1], axis=0) - 2
-                top_x = int(np.average(contour[contour[:, 1] == min_y][:, 0]))
-                bottom_x = int(np.average(contour[contour[:, 1] == max_y][:, 0]))
+            for k in _largest_components(stats):
+                min_y = int(stats[k, cv2.CC_STAT_TOP]) + 2
+                max_y = int(stats[k, cv2.CC_STAT_TOP] + stats[k, cv2.CC_STAT_HEIGHT]) - 1 - 2
+                top_x, bottom_x = _line_end_coords(labels.T, k, min_y, max_y)
                 lines.append((top_x, min_y, bottom_x, max_y))
                 cv2.line(vertical_lines_canvas, (top_x, min_y), (bottom_x, max_y), 1, 1)
-                corners.append((top_x, min_y))
-                corners.append((bottom_x, max_y))
 
-            # find the corners
-            corners_y, corners_x = np.where(horizontal_lines_canvas + vertical_lines_canvas == 2)
-            corners += zip(corners_x, corners_y)
+            # find the corners: the ends of the final lines and the points where they cross
+            corners_y, corners_x = np.nonzero(cv2.bitwise_and(horizontal_lines_canvas, vertical_lines_canvas))
+            corners = np.vstack([np.array(lines, dtype=np.int32).reshape(-1, 2),
+                                 np.stack([corners_x, corners_y], axis=1)]).astype(np.int32)
 
         # remove corners in close proximity
         corners = self.filter_corners(corners)
@@ -199,75 +247,87 @@ class DocScanner(object):
     def get_contour(self, rescaled_image, log_img_dir):
         """
         Returns a numpy array of shape (4, 2) containing the vertices of the four corners
-        of the document in the image. It considers the corners returned from get_corners()
-        and uses heuristics to choose the four corners that most likely represent
-        the corners of the document. If no corners were found, or the four corners represent
+        of the document in the image. It first tries to approximate the largest contours of
+        the edged image by a valid quadrilateral. Failing that, it considers the corners
+        returned from get_corners() and uses heuristics to choose the four corners that most
+        likely represent the corners of the document. If no corners were found, or the four corners represent
         a quadrilateral that is too small or convex, it returns the original four corners.
         """
 
         # these constants are carefully chosen
-        MORPH = 9
         CANNY = 84
         HOUGH = 25
 
         IM_HEIGHT, IM_WIDTH, _ = rescaled_image.shape
-        orig_img = rescaled_image.copy()
+        min_area = IM_WIDTH * IM_HEIGHT * self.MIN_QUAD_AREA_RATIO
         # convert the image to grayscale and blur it slightly
         gray = cv2.cvtColor(rescaled_image, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (7, 7), 0)
+        if hasattr(cv2, 'stackBlur'):
+            gray = cv2.stackBlur(gray, (7, 7))
+        else:
+            gray = cv2.boxFilter(cv2.boxFilter(gray, -1, (3, 3)), -1, (3, 3))
         if self.debug:
             cv2.imwrite(os.path.join(log_img_dir, 'gray.png'), gray)
 
         # dilate helps to remove potential holes between edge segments
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (MORPH, MORPH))
-        dilated = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel)
+        dilated = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, self._morph_kernel)
         if self.debug:
             cv2.imwrite(os.path.join(log_img_dir, 'blured.png'), dilated)
         # find edges and mark them in the output map using the Canny algorithm
         edged = cv2.Canny(dilated, 0, CANNY)
         if self.debug:
             cv2.imwrite(os.path.join(log_img_dir, 'canny.png'), edged)
-        test_corners = self.get_corners(edged, log_img_dir, orig_img)
+
+        # first attempt to find contours directly from the edged image, which is much cheaper
+        # than the LSD based corner search below and is often good enough
+        (cnts, hierarchy) = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cnts = sorted(cnts, key=cv2.contourArea, reverse=True)[:5]
+
+        if self.debug:
+            contours_img = rescaled_image.copy()
+            cv2.drawContours(contours_img, cnts, -1, (0, 255, 0), 3)
+            cv2.imwrite(os.path.join(log_img_dir, 'programmed_contours.png'), contours_img)
+        # loop over the contours
+        for c in cnts:
+            # the contours are sorted by area, so once one is too small the rest are too
+            if cv2.contourArea(c) < min_area:
+                break
+            # approximate the contour
+            approx = cv2.approxPolyDP(c, 0.02 * cv2.arcLength(c, True), True)
+            if self.is_valid_contour(approx, IM_WIDTH, IM_HEIGHT):
+                return approx.reshape(4, 2), True
+
+        # otherwise fall back to corners from line segment detection
+        test_corners = self.get_corners(edged, log_img_dir, rescaled_image)
 
         approx_contours = []
 
         if len(test_corners) >= 4:
-            quads = []
+            quads = test_corners[_comb_indices(len(test_corners))].astype(np.float32)
 
-            for quad in itertools.combinations(test_corners, 4):
-                points = np.array(quad)
-                points = transform.order_points(points)
-                points = np.array([[p] for p in points], dtype="int32")
-                quads.append(points)
+            # a quadrilateral never covers more than its bounding box, so candidates
+            # with a small bounding box can be dropped before ordering them
+            quads = quads[np.ptp(quads, axis=1).prod(axis=1) > min_area]
 
-            # get top five quadrilaterals by area
-            quads = sorted(quads, key=cv2.contourArea, reverse=True)[:5]
-            # sort candidate quadrilaterals by their angle range, which helps remove outliers
-            quads = sorted(quads, key=self.angle_range)
+            if len(quads):
+                quads = transform.order_points_batch(quads)
 
-            approx = quads[0]
-            if self.is_valid_contour(approx, IM_WIDTH, IM_HEIGHT):
-                approx_contours.append(approx)
+                # shoelace formula over the ordered vertices of every quadrilateral
+                x, y = quads[..., 0], quads[..., 1]
+                areas = 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1))
+
+                # get top five quadrilaterals by area
+                quads = quads[np.argsort(-areas, kind="stable")[:5]]
+                # pick the candidate quadrilateral with the smallest angle range, which helps remove outliers
+                ranges = _all_quad_angle_ranges(quads.astype(np.float64))
+
+                approx = quads[np.argmin(ranges)].reshape(4, 1, 2).astype(np.int32)
+                if self.is_valid_contour(approx, IM_WIDTH, IM_HEIGHT):
+                    approx_contours.append(approx)
 
             # for debugging: uncomment the code below to draw the corners and countour found
             # by get_corners() and overlay it on the image
 
-        # also attempt to find contours directly from the edged image, which occasionally
-        # produces better results
-        (cnts, hierarchy) = cv2.findContours(edged.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cnts = sorted(cnts, key=cv2.contourArea, reverse=True)[:5]
-
-        if self.debug:
-            contours_img = orig_img.copy()
-            cv2.drawContours(contours_img, cnts, -1, (0, 255, 0), 3)
-            cv2.imwrite(os.path.join(log_img_dir, 'programmed_contours.png'), contours_img)
-        # loop over the contours
-        for c in cnts:
-            # approximate the contour
-            approx = cv2.approxPolyDP(c, 80, True)
-            if self.is_valid_contour(approx, IM_WIDTH, IM_HEIGHT):
-                approx_contours.append(approx)
-                break
         has_cnt = len(approx_contours) != 0
         # If we did not find any valid contours, just use the whole image
         if not approx_contours:
@@ -296,23 +356,19 @@ class DocScanner(object):
         new_points = np.array([[p] for p in new_points], dtype="int32")
         return new_points.reshape(4, 2)
 
-    def scan(self, image_path, show):
+    def scan(self, image, image_name, show):
         RESCALED_HEIGHT = 500.0
 
-        img_name = os.path.splitext(os.path.basename(image_path))[0]
+        img_name = os.path.splitext(image_name)[0]
         OUTPUT_DIR = os.path.abspath(os.path.join(os.path.curdir, "output"))
         os.makedirs(OUTPUT_DIR, exist_ok=True)
         log_img_dir = os.path.join(os.path.abspath(OUTPUT_DIR), img_name)
         os.makedirs(log_img_dir, exist_ok=True)
 
-        # load the image and compute the ratio of the old height
-        # to the new height, clone it, and resize it
-        image = cv2.imread(image_path)
-
+        # compute the ratio of the old height to the new height and resize the image
         assert (image is not None)
 
         ratio = image.shape[0] / RESCALED_HEIGHT
-        orig = image.copy()
         rescaled_image = imutils.resize(image, height=int(RESCALED_HEIGHT))
 
         # get the contour of the document
@@ -326,8 +382,10 @@ class DocScanner(object):
             cv2.drawContours(contours, [screenCnt], -1, (0, 255, 0), 3)
             cv2.imwrite(os.path.join(log_img_dir, "contours.png"), contours)
 
-        # apply the perspective transformation
-        warped = transform.four_point_transform(orig, screenCnt * ratio)
+        # apply the perspective transformation. The full resolution chain below runs on
+        # UMats when OpenCL is usable, so OpenCV can offload it to the GPU
+        use_ocl = cv2.ocl.useOpenCL()
+        warped = transform.four_point_transform(cv2.UMat(image) if use_ocl else image, screenCnt * ratio)
         if self.debug:
             cv2.imwrite(os.path.join(log_img_dir, 'perspective.png'), warped)
         # convert the warped image to grayscale
@@ -339,12 +397,14 @@ class DocScanner(object):
 
         # apply adaptive threshold to get black and white effect
         thresh = cv2.adaptiveThreshold(sharpen, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 21, 15)
+        if use_ocl:
+            thresh = thresh.get()
 
         # save the transformed image
-        cv2.imwrite(os.path.join(OUTPUT_DIR, os.path.basename(image_path)), thresh)
+        cv2.imwrite(os.path.join(OUTPUT_DIR, image_name), thresh)
 
         if self.write_contours:
-            cnts = segmentation.segmentation(cv2.imread(os.path.join(OUTPUT_DIR, os.path.basename(image_path))))
+            cnts = segmentation.segmentation(thresh)
             out_path = os.path.join(log_img_dir, 'contours')
             os.makedirs(out_path, exist_ok=True)
             segmented = segmentation.write_contours(thresh, cnts, out_path)
@@ -352,6 +412,13 @@ class DocScanner(object):
         print("Proccessed " + img_name)
 
 
+def _scan_one(args):
+    """Reads and scans a single image of a directory in a worker process"""
+    im_dir, im, verbose, segment = args
+    print(im)
+    DocScanner(False, verbose, segment).scan(cv2.imread(os.path.join(im_dir, im)), im, verbose)
+
+
 def main(opts):
     im_dir = opts["--images"] if opts["--images"] else ''
     im_file = opts["--image"] if opts["--image"] else ''
@@ -368,14 +435,20 @@ def main(opts):
 
     # Scan single image specified by command line argument --image <IMAGE_PATH>
     if im_file:
-        scanner.scan(im_file, verbose)
+        scanner.scan(cv2.imread(im_file), os.path.basename(im_file), verbose)
 
     # Scan all valid images in directory specified by command line argument --images <IMAGE_DIR>
     else:
         im_files = [f for f in os.listdir(im_dir) if get_ext(f) in valid_formats]
-        for im in im_files:
-            print(im)
-            scanner.scan(os.path.join(im_dir, im), verbose)
+        if interactive:
+            # the interactive pyplot window has to stay in the main process
+            for im in im_files:
+                print(im)
+                scanner.scan(cv2.imread(os.path.join(im_dir, im)), im, verbose)
+        else:
+            # each worker reads its own file, so reads overlap the other workers' scanning
+            with ProcessPoolExecutor() as executor:
+                list(executor.map(_scan_one, [(im_dir, im, verbose, segment) for im in im_files]))
     return
 
 
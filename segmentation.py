@@ -1,10 +1,12 @@
 import cv2
+import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 
 def segmentation(image):
-    # Load image, grayscale, Gaussian blur, Otsu's threshold
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Load image, grayscale (unless already single-channel), Gaussian blur, Otsu's threshold
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     blur = cv2.GaussianBlur(gray, (11, 5), 0)
     thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
 
@@ -19,10 +21,19 @@ def segmentation(image):
 
 
 def write_contours(image, cnts, out_dir):
-    orig_img = image.copy()
-    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-    for i, cnt in enumerate(cnts):
-        x, y, w, h = cv2.boundingRect(cnt)
-        cv2.imwrite(os.path.join(out_dir, f'contour_{i}.jpg'), orig_img[y:y + h, x:x + w])
-        cv2.rectangle(image, (x, y), (x + w, y + h), (0, 255, 0), 2)
-    return image
+    # Crop from the untouched input, draw rectangles on a BGR version of it
+    segmented = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+    if len(cnts) == 0:
+        return segmented
+    rects = np.array([cv2.boundingRect(cnt) for cnt in cnts])
+
+    # Encode and write the crops in the background while the rectangles are drawn
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        writes = executor.map(cv2.imwrite,
+                              [os.path.join(out_dir, f'contour_{i}.jpg') for i in range(len(rects))],
+                              [image[y:y + h, x:x + w] for x, y, w, h in rects])
+        x, y, w, h = rects.T
+        boxes = np.stack([x, y, x + w, y, x + w, y + h, x, y + h], axis=1).reshape(-1, 4, 1, 2).astype(np.int32)
+        cv2.polylines(segmented, list(boxes), True, (0, 255, 0), 2)
+        list(writes)
+    return segmented